@@ -6,13 +6,11 @@ import psycopg2.extras
 from psycopg2.extensions import register_adapter, AsIs
 from dotenv import load_dotenv
 from werkzeug.security import generate_password_hash, check_password_hash
-from PIL import Image
 from functools import wraps
 import numpy as np
-import io, os
 from cryptography.fernet import Fernet
-import tensorflow as tf
 from datetime import datetime
+from signature_model import load_embedding_model, load_verification_threshold, preprocess_image
 
 
 
@@ -47,8 +45,7 @@ DB_HOST = "localhost"
 DB_PORT = "5432"
 
 try:
-    triplet_model = tf.keras.models.load_model('best_triplet_model.h5', custom_objects={'triplet_loss': None}, compile=False)
-    embedding_model = triplet_model.get_layer('embedding_model')
+    embedding_model = load_embedding_model('best_triplet_model.h5')
     print("--- AI model loaded successfully ---")
 except Exception as e:
     print(f"Error loading model: {e}")
@@ -62,12 +59,8 @@ def adapt_numpy_array(numpy_array):
     return AsIs(list(numpy_array))
 register_adapter(np.ndarray, adapt_numpy_array)
 
-def preprocess_image(image_bytes):
-    img = Image.open(io.BytesIO(image_bytes)).convert('L')
-    img = img.resize((224, 224))
-    img_array = np.array(img) / 255.0
-    img_array = 1.0 - img_array
-    return np.expand_dims(img_array, axis=0)
+app.config['THRESHOLD_CONFIG'] = os.environ.get('THRESHOLD_CONFIG', 'threshold_config.json')
+app.config['VERIFICATION_THRESHOLD'] = load_verification_threshold(app.config['THRESHOLD_CONFIG'])
 
 # ===================================================================
 #          ENCRYPTION & DECRYPTION HELPER FUNCTIONS
@@ -416,7 +409,7 @@ def api_admin_verify_signature():
     file = request.files['signature_file']
     national_id = request.form.get('national_id')
     admin_id = session['user_id']
-    optimal_threshold = 10.9226  # The threshold from model evaluation
+    optimal_threshold = app.config['VERIFICATION_THRESHOLD']
 
     conn = get_db_connection()
     try:
@@ -0,0 +1,720 @@
+#!/usr/bin/env python3
+"""
+Offline evaluation and threshold calibration for the signature embedding model.
+
+Embeds a labelled signature set (or reads the production HandSignature table),
+accumulates genuine and impostor Euclidean distances block by block into fixed
+histograms, and reports ROC, EER and FAR/FRR curves. The recommended threshold
+can be written to threshold_config.json, which app.py loads on startup.
+
+By default each probe is scored like api_admin_verify_signature scores it: by
+its smallest distance to the claimed writer's other genuine signatures, so the
+reported FAR/FRR describe the production decision. --scores pairwise reports
+single-pair distances instead, which do not.
+
+Usage:
+    # Labelled directory laid out as <root>/<writer>/genuine/* and <root>/<writer>/forged/*
+    python evaluate_threshold.py --dataset /path/to/CEDAR --write-config
+
+    # Stored embeddings of enrolled customers (random-forgery impostors only)
+    python evaluate_threshold.py --database
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+# --- IMPORTANT: Copy your DB credentials from app.py ---
+DB_NAME = "signature_db"
+DB_USER = "syauqi"
+DB_PASS = ""
+DB_HOST = "localhost"
+DB_PORT = "5432"
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.gif'}
+NUM_BINS = 20000
+# Rough peak bytes held per distance-block element: float32 distances, the
+# matmul temporary, intp bin indices and boolean masks.
+BYTES_PER_BLOCK_ELEMENT = 32
+CACHE_FLUSH_SIZE = 4096
+SCORE_NOTES = {
+    'nearest': "FAR/FRR are for the API decision: each probe's minimum distance to the claimed "
+               "writer's other genuine signatures (leave-one-out).",
+    'pairwise': "FAR/FRR are over single signature pairs. The API accepts on the minimum distance "
+                "over all enrolled signatures, so these rates do not describe the production decision.",
+}
+
+
+# ===================================================================
+#                       LOADING SIGNATURES
+# ===================================================================
+
+def scan_labelled_directory(root):
+    """
+    Walks a <root>/<writer>/{genuine,forged}/<image> tree (the layout used by the
+    training notebook) and returns (paths, writer_ids, is_forged).
+    """
+    paths, writer_ids, is_forged = [], [], []
+    writers = sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+    for writer_id, writer in enumerate(writers):
+        for subdir, forged in (('genuine', False), ('forged', True)):
+            folder = os.path.join(root, writer, subdir)
+            if not os.path.isdir(folder):
+                continue
+            for filename in sorted(os.listdir(folder)):
+                if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                    paths.append(os.path.join(folder, filename))
+                    writer_ids.append(writer_id)
+                    is_forged.append(forged)
+    return paths, np.array(writer_ids, dtype=np.int64), np.array(is_forged, dtype=bool)
+
+def parse_vector(value):
+    """Parses a pgvector value, which psycopg2 returns as the text '[x1,x2,...]'."""
+    if isinstance(value, str):
+        return np.array(value.strip('[]').split(','), dtype=np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+def load_database_signatures(fetch_size=10000):
+    """
+    Streams every stored signature from HandSignature with a server-side cursor
+    into a preallocated array. Returns (customer_ids, embeddings), ordered by
+    customer; all rows are genuine.
+    """
+    import psycopg2
+    conn = psycopg2.connect(database=DB_NAME, user=DB_USER, password=DB_PASS, host=DB_HOST, port=DB_PORT)
+    # One snapshot for both queries so the row count matches what the cursor returns.
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM HandSignature")
+            total = cur.fetchone()[0]
+        customer_ids = np.empty(total, dtype=np.int64)
+        embeddings = np.empty((total, 0), dtype=np.float32)
+        with conn.cursor(name='evaluate_threshold') as cur:
+            cur.itersize = fetch_size
+            cur.execute("SELECT customer_id, embedding FROM HandSignature ORDER BY customer_id")
+            for row, (customer_id, embedding) in enumerate(cur):
+                vector = parse_vector(embedding)
+                if row == 0:
+                    embeddings = np.empty((total, len(vector)), dtype=np.float32)
+                customer_ids[row] = customer_id
+                embeddings[row] = vector
+    finally:
+        conn.close()
+    return customer_ids, embeddings
+
+
+# ===================================================================
+#                   BATCHED EMBEDDING WITH CACHING
+# ===================================================================
+
+class EmbeddingCache:
+    """
+    On-disk cache of embeddings keyed by file path, size and mtime, stored as
+    numbered chunks so an interrupted run resumes where it left off. Each chunk
+    is a pair of .npy files (keys and embeddings); embeddings are memory-mapped
+    on lookup so only the requested rows are read. Each model file gets its own
+    sub-directory.
+    """
+
+    def __init__(self, cache_dir, model_path):
+        stat = os.stat(model_path)
+        fingerprint = f"{os.path.abspath(model_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+        self.directory = os.path.join(cache_dir, hashlib.sha1(fingerprint.encode()).hexdigest()[:16])
+        os.makedirs(self.directory, exist_ok=True)
+        self.pending_keys, self.pending_embeddings = [], []
+
+    @staticmethod
+    def key_for(path):
+        stat = os.stat(path)
+        return hashlib.sha1(f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}".encode()).hexdigest()
+
+    def _chunk_numbers(self):
+        names = (f.split('.')[0] for f in os.listdir(self.directory) if f.startswith('chunk_'))
+        return sorted({int(name[6:]) for name in names if name[6:].isdigit()})
+
+    def _chunk_paths(self, number):
+        prefix = os.path.join(self.directory, f"chunk_{number:06d}")
+        return prefix + '.keys.npy', prefix + '.emb.npy'
+
+    def lookup(self, keys, out=None):
+        """
+        Copies cached embeddings for `keys` into the matching rows of `out`
+        (allocated on the first hit if not given). Returns (out, hit_mask).
+        Unreadable chunks are skipped with a warning; their signatures are
+        simply re-embedded and written to a new chunk.
+        """
+        wanted = np.array(keys, dtype='S40')
+        hit = np.zeros(len(wanted), dtype=bool)
+        for number in self._chunk_numbers():
+            keys_path, emb_path = self._chunk_paths(number)
+            if not os.path.exists(keys_path):
+                continue  # keys are written last, so this chunk was never completed
+            try:
+                chunk_keys = np.load(keys_path)
+                chunk_embeddings = np.load(emb_path, mmap_mode='r')
+                if len(chunk_keys) != len(chunk_embeddings):
+                    raise ValueError(f"{len(chunk_keys)} keys for {len(chunk_embeddings)} embeddings")
+            except Exception as e:
+                print(f"Warning: skipping unreadable cache chunk_{number:06d}: {e}")
+                continue
+            if len(chunk_keys) == 0:
+                continue
+            sorter = np.argsort(chunk_keys)
+            positions = np.minimum(np.searchsorted(chunk_keys, wanted, sorter=sorter), len(chunk_keys) - 1)
+            rows = sorter[positions]
+            match = (chunk_keys[rows] == wanted) & ~hit
+            if not match.any():
+                continue
+            if out is None:
+                out = np.full((len(wanted), chunk_embeddings.shape[1]), np.nan, dtype=np.float32)
+            out[match] = chunk_embeddings[rows[match]]
+            hit |= match
+        return out, hit
+
+    def add(self, keys, embeddings):
+        self.pending_keys.extend(keys)
+        self.pending_embeddings.append(np.asarray(embeddings, dtype=np.float32))
+        if len(self.pending_keys) >= CACHE_FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.pending_keys:
+            return
+        # Numbering continues past skipped chunks so an unreadable file is never overwritten.
+        keys_path, emb_path = self._chunk_paths(max(self._chunk_numbers(), default=-1) + 1)
+        # Each file is written under a temporary name and renamed into place, keys
+        # last, so an interrupted run never leaves a truncated chunk behind.
+        for path, array in ((emb_path, np.concatenate(self.pending_embeddings)),
+                            (keys_path, np.array(self.pending_keys, dtype='S40'))):
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(path + '.tmp', path)
+        self.pending_keys, self.pending_embeddings = [], []
+
+def embed_files(paths, model_path, cache_dir=None, batch_size=256, workers=4):
+    """
+    Returns an (N, D) float32 matrix of embeddings for the given image files.
+    Images are decoded on a thread pool and pushed through the model in batches
+    of `batch_size`; rows for unreadable images are NaN. Cached embeddings are
+    reused and new ones are added to the cache.
+    """
+    from signature_model import load_embedding_model, preprocess_image
+
+    def load(path):
+        try:
+            with open(path, 'rb') as f:
+                return preprocess_image(f.read())[0].astype(np.float32)
+        except Exception as e:
+            print(f"Skipping unreadable signature {path}: {e}")
+            return None
+
+    cache = EmbeddingCache(cache_dir, model_path) if cache_dir else None
+    keys = [EmbeddingCache.key_for(p) for p in paths] if cache else [None] * len(paths)
+    embeddings = None
+    if cache:
+        embeddings, hit = cache.lookup(keys)
+        missing = np.flatnonzero(~hit).tolist()
+        print(f"Embedding cache: {len(paths) - len(missing)} hits, {len(missing)} to compute")
+    else:
+        missing = list(range(len(paths)))
+
+    if missing:
+        model = load_embedding_model(model_path)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for start in range(0, len(missing), batch_size):
+                batch = missing[start:start + batch_size]
+                images = list(executor.map(load, (paths[i] for i in batch)))
+                ok = [i for i, img in zip(batch, images) if img is not None]
+                if not ok:
+                    continue
+                batch_embeddings = model.predict(np.stack([img for img in images if img is not None]), verbose=0)
+                if embeddings is None:
+                    embeddings = np.full((len(paths), batch_embeddings.shape[1]), np.nan, dtype=np.float32)
+                embeddings[ok] = batch_embeddings
+                if cache:
+                    cache.add([keys[i] for i in ok], batch_embeddings)
+                print(f"Embedded {min(start + batch_size, len(missing))}/{len(missing)} signatures")
+        if cache:
+            cache.flush()
+
+    if embeddings is None:
+        raise ValueError("None of the signatures could be embedded.")
+    return embeddings
+
+
+# ===================================================================
+#              BLOCKED DISTANCE HISTOGRAMS (MEMORY-BOUNDED)
+# ===================================================================
+
+MIN_BLOCK_SIZE = 64
+
+def block_size_for_budget(memory_mb, resident_bytes=0):
+    """
+    Largest square distance block that fits in what is left of the memory
+    budget once the resident arrays (embeddings, norms, labels) are counted.
+    """
+    workspace = memory_mb * 1024 * 1024 - resident_bytes
+    if workspace < MIN_BLOCK_SIZE * MIN_BLOCK_SIZE * BYTES_PER_BLOCK_ELEMENT:
+        minimum = (resident_bytes + MIN_BLOCK_SIZE * MIN_BLOCK_SIZE * BYTES_PER_BLOCK_ELEMENT) / 1024 / 1024
+        raise ValueError(f"A memory budget of {memory_mb} MB is too small; the embeddings and the "
+                         f"smallest distance block need {minimum:.1f} MB.")
+    return int(np.sqrt(workspace / BYTES_PER_BLOCK_ELEMENT))
+
+def _block_distances(a, a_sq, b, b_sq):
+    """Euclidean distances between two blocks, matching pgvector's <-> operator."""
+    d = a @ b.T
+    d *= -2.0
+    d += a_sq[:, None]
+    d += b_sq[None, :]
+    np.maximum(d, 0.0, out=d)
+    return np.sqrt(d, out=d)
+
+class DistanceHistograms:
+    """Fixed-bin histograms of genuine, skilled-forgery and random-forgery distances."""
+
+    def __init__(self, max_distance, num_bins=NUM_BINS):
+        self.edges = np.linspace(0.0, max_distance, num_bins + 1)
+        self.scale = num_bins / max_distance
+        self.genuine = np.zeros(num_bins, dtype=np.int64)
+        self.skilled = np.zeros(num_bins, dtype=np.int64)
+        self.random = np.zeros(num_bins, dtype=np.int64)
+
+    def add(self, histogram, distances):
+        if distances.size == 0:
+            return
+        bins = (distances * self.scale).astype(np.intp)
+        np.minimum(bins, len(histogram) - 1, out=bins)
+        histogram += np.bincount(bins, minlength=len(histogram))
+
+def _prepare_blocks(embeddings, writer_ids, is_forged, memory_mb, num_bins, inplace):
+    """
+    Orders signatures genuine first and then by writer, centres them and
+    returns (histograms, block size, genuine views, forged views), where each
+    views tuple is (embeddings, squared norms, writer ids).
+
+    With inplace=False the work happens on a single copy and the caller's
+    array is never modified. With inplace=True the caller's float32 array is
+    centred in place; it must already be in that order.
+    """
+    writer_ids = np.asarray(writer_ids, dtype=np.int64)
+    is_forged = np.asarray(is_forged, dtype=bool)
+    order = np.lexsort((writer_ids, is_forged))
+    ordered = not np.any(order != np.arange(len(order)))
+
+    if inplace:
+        if not isinstance(embeddings, np.ndarray) or embeddings.dtype != np.float32:
+            raise ValueError("inplace=True needs a float32 numpy array of embeddings.")
+        if not ordered:
+            raise ValueError("inplace=True needs signatures ordered genuine first, then by writer.")
+    elif ordered:
+        embeddings = np.array(embeddings, dtype=np.float32)
+    else:
+        embeddings = np.asarray(embeddings, dtype=np.float32)[order]
+        writer_ids, is_forged = writer_ids[order], is_forged[order]
+    del order
+
+    # Distances are translation invariant; centring shrinks norms and with
+    # them the float32 cancellation error of the |a|^2 + |b|^2 - 2ab expansion.
+    embeddings -= embeddings.mean(axis=0, dtype=np.float64).astype(np.float32)
+    sq_norms = np.einsum('ij,ij->i', embeddings, embeddings)
+    max_distance = 2.0 * float(np.sqrt(sq_norms.max())) if len(sq_norms) else 1.0
+    hists = DistanceHistograms(max(max_distance, 1e-6), num_bins)
+
+    resident = embeddings.nbytes + sq_norms.nbytes + writer_ids.nbytes + is_forged.nbytes
+    block = block_size_for_budget(memory_mb, resident)
+
+    n = int(np.count_nonzero(~is_forged))
+    genuine = (embeddings[:n], sq_norms[:n], writer_ids[:n])
+    forged = (embeddings[n:], sq_norms[n:], writer_ids[n:])
+    return hists, block, genuine, forged
+
+def compute_distance_histograms(embeddings, writer_ids, is_forged, memory_mb=512,
+                                max_random_pairs=200_000_000, num_bins=NUM_BINS, seed=0, inplace=False):
+    """
+    Accumulates pairwise distances into histograms without materialising the
+    full distance matrix. Pairs are classified as:
+      genuine - two genuine signatures of the same writer
+      skilled - a genuine and a forged signature of the same writer
+      random  - genuine signatures of two different writers
+    Signatures are sorted by writer so same-writer pairs sit near the diagonal;
+    off-diagonal blocks only contribute random pairs and are sampled at a rate
+    that keeps the total near `max_random_pairs`.
+
+    `memory_mb` covers the working embeddings, their norms and labels plus the
+    block workspace. By default the embeddings are copied once and the input is
+    left untouched; the caller's array then comes on top of the budget. Pass
+    inplace=True to centre a float32 array, already ordered genuine first and
+    then by writer, in place instead. main() orders signatures that way before
+    embedding and does this.
+    """
+    hists, block, g, f = _prepare_blocks(embeddings, writer_ids, is_forged, memory_mb, num_bins, inplace)
+    g_emb, g_sq, g_wr = g
+    f_emb, f_sq, f_wr = f
+    rng = np.random.default_rng(seed)
+
+    n = len(g_emb)
+    _, writer_counts = np.unique(g_wr, return_counts=True)
+    same_writer_pairs = int((writer_counts * (writer_counts - 1) // 2).sum())
+    total_random_pairs = n * (n - 1) // 2 - same_writer_pairs
+    random_rate = min(1.0, max_random_pairs / total_random_pairs) if total_random_pairs else 1.0
+
+    # Genuine vs genuine: upper triangle of the block grid.
+    for i0 in range(0, n, block):
+        i1 = min(i0 + block, n)
+        for j0 in range(i0, n, block):
+            j1 = min(j0 + block, n)
+            overlaps = g_wr[i1 - 1] >= g_wr[j0]
+            sample_random = random_rate >= 1.0 or rng.random() < random_rate
+            if not overlaps and not sample_random:
+                continue
+            d = _block_distances(g_emb[i0:i1], g_sq[i0:i1], g_emb[j0:j1], g_sq[j0:j1])
+            if i0 == j0:
+                upper = np.triu(np.ones(d.shape, dtype=bool), k=1)
+            else:
+                upper = None
+            if overlaps:
+                same = g_wr[i0:i1, None] == g_wr[None, j0:j1]
+                genuine_mask = same & upper if upper is not None else same
+                hists.add(hists.genuine, d[genuine_mask])
+                if sample_random:
+                    random_mask = ~same & upper if upper is not None else ~same
+                    hists.add(hists.random, d[random_mask])
+            else:
+                hists.add(hists.random, d.ravel())
+
+    # Genuine vs forged: only same-writer pairs, found by range lookup on the sorted writer ids.
+    for i0 in range(0, n, block):
+        i1 = min(i0 + block, n)
+        f_start = np.searchsorted(f_wr, g_wr[i0], side='left')
+        f_end = np.searchsorted(f_wr, g_wr[i1 - 1], side='right')
+        for j0 in range(f_start, f_end, block):
+            j1 = min(j0 + block, f_end)
+            d = _block_distances(g_emb[i0:i1], g_sq[i0:i1], f_emb[j0:j1], f_sq[j0:j1])
+            same = g_wr[i0:i1, None] == f_wr[None, j0:j1]
+            hists.add(hists.skilled, d[same])
+
+    return hists
+
+
+def _writer_aligned_blocks(writer_ids, block):
+    """
+    Splits a writer-sorted range into column blocks of about `block` rows that
+    never split a writer (a writer larger than `block` gets a block of its own).
+    Returns (start, end, segment starts relative to start) per block.
+    """
+    if len(writer_ids) == 0:
+        return []
+    starts = np.flatnonzero(np.r_[True, writer_ids[1:] != writer_ids[:-1]])
+    bounds = np.r_[starts, len(writer_ids)]
+    blocks, i = [], 0
+    while i < len(starts):
+        j = max(i + 1, int(np.searchsorted(bounds, bounds[i] + block, side='right')) - 1)
+        blocks.append((int(bounds[i]), int(bounds[j]), starts[i:j] - bounds[i]))
+        i = j
+    return blocks
+
+def compute_nearest_reference_histograms(embeddings, writer_ids, is_forged, memory_mb=512,
+                                         max_random_claims=200_000_000, num_bins=NUM_BINS, seed=0,
+                                         inplace=False):
+    """
+    Scores each probe the way api_admin_verify_signature decides: by its
+    smallest distance to the claimed writer's enrolled genuine signatures.
+      genuine - a genuine probe against its own writer's other genuine signatures
+      skilled - a forged probe against the genuine signatures of the writer it imitates
+      random  - a genuine probe claiming to be a different writer
+    Column blocks never split a writer, so each per-writer minimum comes from
+    a single block. Random claims are sampled by block at a rate that keeps
+    the total near `max_random_claims`. Memory use and `inplace` are as for
+    compute_distance_histograms.
+    """
+    hists, block, g, f = _prepare_blocks(embeddings, writer_ids, is_forged, memory_mb, num_bins, inplace)
+    g_emb, g_sq, g_wr = g
+    f_emb, f_sq, f_wr = f
+    rng = np.random.default_rng(seed)
+
+    n = len(g_emb)
+    column_blocks = _writer_aligned_blocks(g_wr, block)
+    column_starts = np.array([c0 for c0, _, _ in column_blocks], dtype=np.int64)
+    num_writers = int(sum(len(segments) for _, _, segments in column_blocks))
+    total_random_claims = n * (num_writers - 1)
+    random_rate = min(1.0, max_random_claims / total_random_claims) if total_random_claims > 0 else 1.0
+
+    # Genuine probes against every writer's references, leaving the probe itself out.
+    for i0 in range(0, n, block):
+        i1 = min(i0 + block, n)
+        for c0, c1, segments in column_blocks:
+            overlaps = g_wr[i0] <= g_wr[c1 - 1] and g_wr[i1 - 1] >= g_wr[c0]
+            sample_random = random_rate >= 1.0 or rng.random() < random_rate
+            if not overlaps and not sample_random:
+                continue
+            d = _block_distances(g_emb[i0:i1], g_sq[i0:i1], g_emb[c0:c1], g_sq[c0:c1])
+            own = np.arange(max(i0, c0), min(i1, c1))
+            d[own - i0, own - c0] = np.inf
+            minima = np.minimum.reduceat(d, segments, axis=1)
+            same = g_wr[i0:i1, None] == g_wr[c0 + segments][None, :]
+            if overlaps:
+                genuine_scores = minima[same]
+                # Writers with a single genuine signature have no other reference.
+                hists.add(hists.genuine, genuine_scores[np.isfinite(genuine_scores)])
+            if sample_random:
+                hists.add(hists.random, minima[~same])
+
+    # Forged probes against the references of the writer they imitate.
+    for i0 in range(0, len(f_emb), block):
+        i1 = min(i0 + block, len(f_emb))
+        lo = np.searchsorted(g_wr, f_wr[i0], side='left')
+        hi = np.searchsorted(g_wr, f_wr[i1 - 1], side='right')
+        first = max(0, int(np.searchsorted(column_starts, lo, side='right')) - 1)
+        last = int(np.searchsorted(column_starts, hi, side='left'))
+        for c0, c1, segments in column_blocks[first:last]:
+            d = _block_distances(f_emb[i0:i1], f_sq[i0:i1], g_emb[c0:c1], g_sq[c0:c1])
+            minima = np.minimum.reduceat(d, segments, axis=1)
+            same = f_wr[i0:i1, None] == g_wr[c0 + segments][None, :]
+            hists.add(hists.skilled, minima[same])
+
+    return hists
+
+# ===================================================================
+#                     ROC, EER AND THRESHOLD CHOICE
+# ===================================================================
+
+def compute_curves(genuine_hist, impostor_hists, edges):
+    """
+    Turns score histograms (pairwise or nearest-reference distances) into
+    FAR/FRR curves. `impostor_hists` maps an impostor class ('skilled',
+    'random') to its histogram. A signature is accepted when its score is
+    below the threshold, so at threshold edges[k + 1]:
+      FAR(class) = class scores < threshold / class scores
+      FAR        = mean of FAR(class) over the classes that have scores
+      FRR        = genuine scores >= threshold / genuine scores
+    Averaging per-class rates keeps each class's weight fixed, so neither the
+    random-claim sampling rate nor the much larger number of random claims
+    changes the operating point.
+    """
+    genuine_total = genuine_hist.sum()
+    if genuine_total == 0:
+        raise ValueError("No genuine scores found; every writer needs at least two genuine signatures.")
+    far_by_class = {name: np.cumsum(hist) / hist.sum() for name, hist in impostor_hists.items() if hist.sum() > 0}
+    if not far_by_class:
+        raise ValueError("No impostor scores found; add forgeries or more writers.")
+    far = np.mean(list(far_by_class.values()), axis=0)
+    frr = 1.0 - np.cumsum(genuine_hist) / genuine_total
+    return {'thresholds': edges[1:], 'far': far, 'frr': frr, 'tpr': 1.0 - frr, 'far_by_class': far_by_class}
+
+def summarise_curves(curves, target_far=None):
+    """Picks the EER, Youden and (optionally) fixed-FAR operating points and the ROC AUC."""
+    thresholds, far, frr, tpr = curves['thresholds'], curves['far'], curves['frr'], curves['tpr']
+    far_by_class = curves.get('far_by_class', {})
+
+    eer_idx = int(np.argmin(np.abs(far - frr)))
+    youden_idx = int(np.argmax(tpr - far))
+    roc_far = np.concatenate(([0.0], far))
+    roc_tpr = np.concatenate(([0.0], tpr))
+    auc = float(np.sum(np.diff(roc_far) * (roc_tpr[1:] + roc_tpr[:-1]) / 2.0))
+
+    def point(idx):
+        result = {'threshold': float(thresholds[idx]), 'far': float(far[idx]), 'frr': float(frr[idx])}
+        for name, class_far in far_by_class.items():
+            result[f'far_{name}'] = float(class_far[idx])
+        return result
+
+    summary = {
+        'auc': auc,
+        'eer': float((far[eer_idx] + frr[eer_idx]) / 2.0),
+        'eer_point': point(eer_idx),
+        'youden_point': point(youden_idx),
+    }
+    if target_far is not None:
+        allowed = np.flatnonzero(far <= target_far)
+        if len(allowed) == 0:
+            raise ValueError(f"No threshold reaches a FAR of {target_far}.")
+        summary['target_far'] = target_far
+        summary['target_far_point'] = point(int(allowed[-1]))
+    return summary
+
+def write_curves_csv(path, curves, hists):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        far_by_class = curves['far_by_class']
+        class_fars = [far_by_class.get(name, np.full(len(curves['far']), np.nan)) for name in ('skilled', 'random')]
+        writer.writerow(['threshold', 'far', 'frr', 'tpr', 'far_skilled', 'far_random',
+                         'genuine_count', 'skilled_count', 'random_count'])
+        for row in zip(curves['thresholds'], curves['far'], curves['frr'], curves['tpr'], *class_fars,
+                       hists.genuine, hists.skilled, hists.random):
+            writer.writerow([f"{value:.8f}" for value in row[:6]] + list(row[6:]))
+
+def plot_curves(output_dir, curves, summary):
+    """Saves ROC and FAR/FRR plots when matplotlib is available."""
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib not installed; skipping plots (curves.csv has the same data).")
+        return
+
+    plt.figure(figsize=(6, 6))
+    plt.plot(curves['far'], curves['tpr'], label=f"AUC = {summary['auc']:.4f}")
+    plt.plot([0, 1], [0, 1], 'k--', linewidth=0.8)
+    plt.xlabel('False Acceptance Rate')
+    plt.ylabel('True Acceptance Rate')
+    plt.title('ROC Curve')
+    plt.legend(loc='lower right')
+    plt.savefig(os.path.join(output_dir, 'roc_curve.png'))
+    plt.close()
+
+    plt.figure(figsize=(8, 5))
+    plt.plot(curves['thresholds'], curves['far'], label='FAR')
+    plt.plot(curves['thresholds'], curves['frr'], label='FRR')
+    plt.axvline(summary['recommended_threshold'], color='k', linestyle='--', linewidth=0.8,
+                label=f"threshold = {summary['recommended_threshold']:.4f}")
+    plt.xlabel('Distance threshold')
+    plt.ylabel('Error rate')
+    plt.title(f"FAR / FRR (EER = {summary['eer']:.4f})")
+    plt.legend()
+    plt.savefig(os.path.join(output_dir, 'far_frr_curve.png'))
+    plt.close()
+
+
+# ===================================================================
+#                       MAIN EXECUTION BLOCK
+# ===================================================================
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate the signature model and calibrate its verification threshold.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--dataset', help="Labelled directory laid out as <writer>/genuine/* and <writer>/forged/*")
+    source.add_argument('--database', action='store_true', help="Use the embeddings stored in HandSignature")
+    parser.add_argument('--model', default='best_triplet_model.h5', help="Trained triplet model (default: %(default)s)")
+    parser.add_argument('--cache-dir', default='.embedding_cache', help="Embedding cache directory; '' disables caching")
+    parser.add_argument('--batch-size', type=int, default=256, help="Images per model.predict call")
+    parser.add_argument('--workers', type=int, default=4, help="Threads used to decode images")
+    parser.add_argument('--memory-mb', type=int, default=512, help="Memory budget for the embeddings plus the distance workspace "
+                             "(the TensorFlow model is not counted)")
+    parser.add_argument('--scores', choices=['nearest', 'pairwise'], default='nearest',
+                        help="nearest: minimum distance to the claimed writer's references, as the API decides; "
+                             "pairwise: every single-pair distance")
+    parser.add_argument('--max-random-pairs', type=int, default=200_000_000,
+                        help="Upper bound on sampled random-forgery pairs (or claims with --scores nearest)")
+    parser.add_argument('--impostors', choices=['all', 'skilled', 'random'], default='all',
+                        help="Which impostor classes drive the FAR; 'all' averages the skilled "
+                             "and random FAR with equal weight")
+    parser.add_argument('--criterion', choices=['eer', 'youden', 'far'], default='eer',
+                        help="Operating point to recommend (the notebook used youden)")
+    parser.add_argument('--target-far', type=float, help="Target FAR, required with --criterion far")
+    parser.add_argument('--output-dir', default='evaluation_output', help="Where curves and the report are written")
+    parser.add_argument('--write-config', action='store_true', help="Also write the recommended threshold to --config (needs --scores nearest)")
+    parser.add_argument('--config', default=os.environ.get('THRESHOLD_CONFIG', 'threshold_config.json'),
+                        help="Threshold config loaded by app.py (default: %(default)s)")
+    args = parser.parse_args(argv)
+    if args.criterion == 'far' and args.target_far is None:
+        parser.error("--criterion far requires --target-far")
+    if args.write_config and args.scores != 'nearest':
+        parser.error("--write-config requires --scores nearest; pairwise scores do not describe the API decision")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    print("--- Loading signatures ---")
+    if args.dataset:
+        paths, writer_ids, is_forged = scan_labelled_directory(args.dataset)
+        print(f"Found {len(paths)} signatures ({int(is_forged.sum())} forged) from {len(np.unique(writer_ids))} writers")
+        # Embed in the order the distance pass needs so the matrix is never copied to reorder it.
+        order = np.lexsort((writer_ids, is_forged))
+        paths, writer_ids, is_forged = [paths[i] for i in order], writer_ids[order], is_forged[order]
+        embeddings = embed_files(paths, args.model, args.cache_dir or None, args.batch_size, args.workers)
+        source = os.path.abspath(args.dataset)
+    else:
+        writer_ids, embeddings = load_database_signatures()
+        is_forged = np.zeros(len(writer_ids), dtype=bool)
+        print(f"Loaded {len(writer_ids)} stored signatures from {len(np.unique(writer_ids))} customers")
+        source = 'database:HandSignature'
+
+    if len(embeddings) == 0:
+        raise ValueError("No signatures found.")
+    # Unreadable images leave whole rows of NaN, so checking one column is enough.
+    valid = ~np.isnan(embeddings[:, 0])
+    if not valid.all():
+        print(f"Excluding {int((~valid).sum())} signatures without an embedding")
+        embeddings, writer_ids, is_forged = embeddings[valid], writer_ids[valid], is_forged[valid]
+
+    print(f"--- Computing {args.scores} distance histograms ---")
+    if args.scores == 'nearest':
+        hists = compute_nearest_reference_histograms(embeddings, writer_ids, is_forged,
+                                                     memory_mb=args.memory_mb, max_random_claims=args.max_random_pairs,
+                                                     inplace=True)
+    else:
+        hists = compute_distance_histograms(embeddings, writer_ids, is_forged,
+                                            memory_mb=args.memory_mb, max_random_pairs=args.max_random_pairs,
+                                            inplace=True)
+    impostor_hists = {name: getattr(hists, name) for name in ('skilled', 'random')
+                      if args.impostors in ('all', name)}
+
+    curves = compute_curves(hists.genuine, impostor_hists, hists.edges)
+    summary = summarise_curves(curves, args.target_far)
+    recommended = summary[{'eer': 'eer_point', 'youden': 'youden_point', 'far': 'target_far_point'}[args.criterion]]
+    summary.update({
+        'recommended_threshold': recommended['threshold'],
+        'recommended_point': recommended,
+        'criterion': args.criterion,
+        'scores': args.scores,
+        'score_note': SCORE_NOTES[args.scores],
+        'impostors': args.impostors,
+        'far_classes': sorted(curves['far_by_class']),
+        'source': source,
+        'model': os.path.abspath(args.model),
+        'num_signatures': int(len(embeddings)),
+        'num_writers': int(len(np.unique(writer_ids))),
+        'genuine_count': int(hists.genuine.sum()),
+        'skilled_count': int(hists.skilled.sum()),
+        'random_count': int(hists.random.sum()),
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+    })
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    write_curves_csv(os.path.join(args.output_dir, 'curves.csv'), curves, hists)
+    with open(os.path.join(args.output_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    plot_curves(args.output_dir, curves, summary)
+
+    print("--- Results ---")
+    print(f"Scores ({args.scores}): {summary['genuine_count']} genuine, {summary['skilled_count']} skilled, "
+          f"{summary['random_count']} random")
+    print(summary['score_note'])
+    print(f"AUC: {summary['auc']:.4f}   EER: {summary['eer']:.4f} at threshold {summary['eer_point']['threshold']:.4f}")
+    print(f"Recommended threshold ({args.criterion}): {recommended['threshold']:.4f} "
+          f"(FAR {recommended['far']:.4f}, FRR {recommended['frr']:.4f})")
+    for name in sorted(curves['far_by_class']):
+        print(f"  {name} FAR at this threshold: {recommended[f'far_{name}']:.4f}")
+    print(f"Report written to {args.output_dir}")
+
+    if args.write_config:
+        config = {
+            'threshold': recommended['threshold'],
+            'far': recommended['far'],
+            'frr': recommended['frr'],
+            **{key: value for key, value in recommended.items() if key.startswith('far_')},
+            'criterion': args.criterion,
+            'scores': args.scores,
+            'source': source,
+            'generated_at': summary['generated_at'],
+        }
+        with open(args.config, 'w') as f:
+            json.dump(config, f, indent=2)
+        print(f"Threshold written to {args.config}; restart app.py to apply it.")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
@@ -0,0 +1,48 @@
+import io
+import json
+import math
+import numpy as np
+from PIL import Image
+
+DEFAULT_VERIFICATION_THRESHOLD = 10.9226  # The threshold from model evaluation in the training notebook
+
+
+def load_embedding_model(model_path='best_triplet_model.h5'):
+    """Loads the trained triplet model and returns its embedding sub-model."""
+    import tensorflow as tf
+    triplet_model = tf.keras.models.load_model(model_path, custom_objects={'triplet_loss': None}, compile=False)
+    return triplet_model.get_layer('embedding_model')
+
+def preprocess_image(image_bytes):
+    """
+    Converts raw image bytes into the (1, 224, 224) inverted grayscale array
+    the embedding model expects. Shared by the API and the offline evaluator
+    so that calibration always sees exactly what production sees.
+    """
+    img = Image.open(io.BytesIO(image_bytes)).convert('L')
+    img = img.resize((224, 224))
+    img_array = np.array(img) / 255.0
+    img_array = 1.0 - img_array
+    return np.expand_dims(img_array, axis=0)
+
+def load_verification_threshold(config_path):
+    """
+    Reads the calibrated threshold written by evaluate_threshold.py, falling
+    back to the notebook value. Logs which threshold is in use either way so
+    operators can tell whether calibration took effect.
+    """
+    try:
+        with open(config_path) as f:
+            threshold = float(json.load(f)['threshold'])
+        # json accepts NaN and Infinity; either, or a non-positive value, would
+        # make every verification pass or fail.
+        if not math.isfinite(threshold) or threshold <= 0:
+            raise ValueError(f"threshold must be a finite positive number, got {threshold}")
+        print(f"--- Verification threshold {threshold:.4f} loaded from {config_path} ---")
+        return threshold
+    except FileNotFoundError:
+        print(f"--- No threshold config at {config_path}; using default threshold {DEFAULT_VERIFICATION_THRESHOLD} ---")
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Error loading threshold config {config_path}: {e}")
+        print(f"--- Using default threshold {DEFAULT_VERIFICATION_THRESHOLD} ---")
+    return DEFAULT_VERIFICATION_THRESHOLD
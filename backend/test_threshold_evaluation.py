@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Test script to verify the blocked distance histograms and threshold calibration
+in evaluate_threshold.py against a brute-force computation on synthetic embeddings,
+plus the embedding cache and the threshold config loaded by app.py.
+"""
+
+import json
+import os
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+import evaluate_threshold
+import signature_model
+from evaluate_threshold import (EmbeddingCache, compute_curves, compute_distance_histograms,
+                                compute_nearest_reference_histograms, parse_vector, summarise_curves)
+from signature_model import DEFAULT_VERIFICATION_THRESHOLD, load_verification_threshold
+
+
+def make_synthetic_signatures(num_writers=12, genuine_per_writer=6, forged_per_writer=4, dim=16, seed=1,
+                              forged_spread=3.0):
+    """Writers are well-separated cluster centres; forgeries sit further from the centre than genuines."""
+    rng = np.random.default_rng(seed)
+    embeddings, writer_ids, is_forged = [], [], []
+    for writer in rng.permutation(num_writers):
+        centre = rng.normal(scale=10.0, size=dim)
+        for forged, count, spread in ((False, genuine_per_writer, 0.5), (True, forged_per_writer, forged_spread)):
+            embeddings.append(centre + rng.normal(scale=spread, size=(count, dim)))
+            writer_ids += [writer] * count
+            is_forged += [forged] * count
+    return np.concatenate(embeddings).astype(np.float32), np.array(writer_ids), np.array(is_forged)
+
+def brute_force_distances(embeddings, writer_ids, is_forged):
+    genuine, skilled, random = [], [], []
+    for i in range(len(embeddings)):
+        for j in range(i + 1, len(embeddings)):
+            d = float(np.linalg.norm(embeddings[i].astype(np.float64) - embeddings[j]))
+            same = writer_ids[i] == writer_ids[j]
+            if same and not is_forged[i] and not is_forged[j]:
+                genuine.append(d)
+            elif same and is_forged[i] != is_forged[j]:
+                skilled.append(d)
+            elif not same and not is_forged[i] and not is_forged[j]:
+                random.append(d)
+    return np.array(genuine), np.array(skilled), np.array(random)
+
+def brute_force_nearest_scores(embeddings, writer_ids, is_forged):
+    """Minimum distance from each probe to each claimed writer's genuine signatures, excluding the probe itself."""
+    genuine, skilled, random = [], [], []
+    for i in range(len(embeddings)):
+        for writer in np.unique(writer_ids):
+            refs = np.flatnonzero((writer_ids == writer) & ~is_forged)
+            refs = refs[refs != i]
+            if len(refs) == 0 or (is_forged[i] and writer != writer_ids[i]):
+                continue
+            d = np.linalg.norm(embeddings[refs].astype(np.float64) - embeddings[i], axis=1).min()
+            if writer != writer_ids[i]:
+                random.append(d)
+            elif is_forged[i]:
+                skilled.append(d)
+            else:
+                genuine.append(d)
+    return np.array(genuine), np.array(skilled), np.array(random)
+
+def assert_histogram_matches(name, blocked, expected, edges):
+    assert blocked.sum() == len(expected), f"{name}: {blocked.sum()} scores, expected {len(expected)}"
+    expected_hist, _ = np.histogram(np.minimum(expected, edges[-1] * (1 - 1e-9)), bins=edges)
+    # float32 rounding can move a distance sitting on a bin edge into its neighbour.
+    assert np.abs(np.cumsum(blocked) - np.cumsum(expected_hist)).max() <= 2, f"{name} histogram differs"
+
+def test_blocked_histograms_match_brute_force():
+    embeddings, writer_ids, is_forged = make_synthetic_signatures()
+    # A tiny memory budget forces many blocks, including writers split across block boundaries.
+    hists = compute_distance_histograms(embeddings, writer_ids, is_forged, memory_mb=0.15, num_bins=500)
+    genuine, skilled, random = brute_force_distances(embeddings, writer_ids, is_forged)
+
+    for name, blocked, expected in (('genuine', hists.genuine, genuine),
+                                    ('skilled', hists.skilled, skilled),
+                                    ('random', hists.random, random)):
+        assert_histogram_matches(name, blocked, expected, hists.edges)
+
+def test_nearest_reference_scores_match_brute_force():
+    # Uneven writer sizes, including a writer with a single genuine signature and
+    # one larger than a block, exercise the writer-aligned column blocks.
+    embeddings, writer_ids, is_forged = make_synthetic_signatures(num_writers=20)
+    extra, extra_writers, extra_forged = make_synthetic_signatures(num_writers=2, genuine_per_writer=1, seed=2)
+    big, big_writers, big_forged = make_synthetic_signatures(num_writers=1, genuine_per_writer=90, seed=3)
+    embeddings = np.concatenate([embeddings, extra, big])
+    writer_ids = np.concatenate([writer_ids, extra_writers + 100, big_writers + 200])
+    is_forged = np.concatenate([is_forged, extra_forged, big_forged])
+    genuine, skilled, random = brute_force_nearest_scores(embeddings, writer_ids, is_forged)
+
+    hists = compute_nearest_reference_histograms(embeddings, writer_ids, is_forged, memory_mb=0.2, num_bins=500)
+    for name, blocked, expected in (('genuine', hists.genuine, genuine),
+                                    ('skilled', hists.skilled, skilled),
+                                    ('random', hists.random, random)):
+        assert_histogram_matches(name, blocked, expected, hists.edges)
+
+def test_random_pairs_are_sampled_without_losing_genuine_pairs():
+    embeddings, writer_ids, is_forged = make_synthetic_signatures(num_writers=100)
+    full = compute_distance_histograms(embeddings, writer_ids, is_forged, memory_mb=0.25)
+    sampled = compute_distance_histograms(embeddings, writer_ids, is_forged, memory_mb=0.25, max_random_pairs=20000)
+
+    assert sampled.genuine.sum() == full.genuine.sum()
+    assert sampled.skilled.sum() == full.skilled.sum()
+    assert 0 < sampled.random.sum() < full.random.sum()
+
+def test_threshold_separates_genuine_from_forged():
+    embeddings, writer_ids, is_forged = make_synthetic_signatures()
+    hists = compute_distance_histograms(embeddings, writer_ids, is_forged)
+    genuine, skilled, random = brute_force_distances(embeddings, writer_ids, is_forged)
+
+    curves = compute_curves(hists.genuine, {'skilled': hists.skilled, 'random': hists.random}, hists.edges)
+    summary = summarise_curves(curves, target_far=0.0)
+
+    assert np.all(np.diff(curves['far']) >= 0) and np.all(np.diff(curves['frr']) <= 0)
+    assert summary['eer'] < 0.05
+    assert summary['auc'] > 0.95
+    threshold = summary['target_far_point']['threshold']
+    assert np.all(np.concatenate([skilled, random]) >= threshold - 1e-3)
+
+def test_random_claim_sampling_does_not_move_recommended_threshold():
+    # Forgeries overlap the genuine scores, and random claims far outnumber them.
+    embeddings, writer_ids, is_forged = make_synthetic_signatures(num_writers=300, forged_spread=0.6)
+    thresholds, random_counts = [], []
+    for max_random_claims in (10**9, 20000, 3000):
+        hists = compute_nearest_reference_histograms(embeddings, writer_ids, is_forged, memory_mb=1,
+                                                     max_random_claims=max_random_claims)
+        curves = compute_curves(hists.genuine, {'skilled': hists.skilled, 'random': hists.random}, hists.edges)
+        summary = summarise_curves(curves)
+        thresholds.append(summary['eer_point']['threshold'])
+        random_counts.append(int(hists.random.sum()))
+        assert set(summary['eer_point']) >= {'far_skilled', 'far_random'}
+
+    assert random_counts[0] > random_counts[1] > random_counts[2]
+    assert max(thresholds) - min(thresholds) <= 0.01 * thresholds[0], thresholds
+
+def test_histograms_leave_input_untouched_unless_inplace():
+    embeddings, writer_ids, is_forged = make_synthetic_signatures()
+    order = np.lexsort((writer_ids, is_forged))
+    for ordered in (False, True):
+        if ordered:
+            embeddings, writer_ids, is_forged = embeddings[order], writer_ids[order], is_forged[order]
+        original = embeddings.copy()
+        compute_distance_histograms(embeddings, writer_ids, is_forged)
+        compute_nearest_reference_histograms(embeddings, writer_ids, is_forged)
+        assert np.array_equal(embeddings, original)
+
+    compute_nearest_reference_histograms(embeddings, writer_ids, is_forged, inplace=True)
+    assert np.allclose(embeddings.mean(axis=0), 0.0, atol=1e-4)
+
+    unordered = embeddings[::-1].copy()
+    try:
+        compute_distance_histograms(unordered, writer_ids[::-1], is_forged[::-1], inplace=True)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("inplace=True accepted unordered signatures")
+
+def make_files(directory, *names):
+    paths = []
+    for name in names:
+        paths.append(os.path.join(directory, name))
+        with open(paths[-1], 'wb') as f:
+            f.write(name.encode())
+    return paths
+
+def test_embedding_cache_round_trip_and_resume():
+    with tempfile.TemporaryDirectory() as tmp:
+        model, a, b, c = make_files(tmp, 'model.h5', 'a.png', 'b.png', 'c.png')
+        key_a, key_b, key_c = (EmbeddingCache.key_for(p) for p in (a, b, c))
+
+        cache = EmbeddingCache(os.path.join(tmp, 'cache'), model)
+        cache.add([key_a], np.full((1, 4), 1.0))
+        cache.flush()
+        cache.add([key_b], np.full((1, 4), 2.0))
+        cache.flush()
+
+        # A fresh instance (a resumed run) finds both chunks and reports the miss.
+        embeddings, hit = EmbeddingCache(os.path.join(tmp, 'cache'), model).lookup([key_b, key_c, key_a])
+        assert hit.tolist() == [True, False, True]
+        assert embeddings[0].tolist() == [2.0] * 4 and embeddings[2].tolist() == [1.0] * 4
+        assert np.isnan(embeddings[1]).all()
+        assert not [f for f in os.listdir(cache.directory) if f.endswith('.tmp')]
+
+def test_embedding_cache_skips_truncated_chunk():
+    with tempfile.TemporaryDirectory() as tmp:
+        model, a, b = make_files(tmp, 'model.h5', 'a.png', 'b.png')
+        key_a, key_b = EmbeddingCache.key_for(a), EmbeddingCache.key_for(b)
+        cache = EmbeddingCache(os.path.join(tmp, 'cache'), model)
+        cache.add([key_a], np.full((1, 4), 1.0))
+        cache.flush()
+        cache.add([key_b], np.full((1, 4), 2.0))
+        cache.flush()
+        with open(os.path.join(cache.directory, 'chunk_000000.emb.npy'), 'r+b') as f:
+            f.truncate(20)
+
+        cache = EmbeddingCache(os.path.join(tmp, 'cache'), model)
+        embeddings, hit = cache.lookup([key_a, key_b])
+        assert hit.tolist() == [False, True]
+
+        # Re-embedding the lost signature writes a new chunk without touching the broken one.
+        cache.add([key_a], np.full((1, 4), 3.0))
+        cache.flush()
+        embeddings, hit = cache.lookup([key_a, key_b])
+        assert hit.all() and embeddings[0].tolist() == [3.0] * 4
+
+def test_embedding_cache_is_keyed_by_model_and_file_contents():
+    with tempfile.TemporaryDirectory() as tmp:
+        model, other_model, a = make_files(tmp, 'model.h5', 'other.h5', 'a.png')
+        key = EmbeddingCache.key_for(a)
+        cache = EmbeddingCache(os.path.join(tmp, 'cache'), model)
+        cache.add([key], np.ones((1, 4)))
+        cache.flush()
+
+        assert not EmbeddingCache(os.path.join(tmp, 'cache'), other_model).lookup([key])[1].any()
+        with open(a, 'ab') as f:
+            f.write(b'changed')
+        assert EmbeddingCache.key_for(a) != key
+
+def test_parse_vector_reads_pgvector_text():
+    vector = parse_vector('[1.5,-2,3e-1]')
+    assert vector.dtype == np.float32
+    assert np.allclose(vector, [1.5, -2.0, 0.3])
+    assert np.allclose(parse_vector([1, 2]), [1.0, 2.0])
+
+def test_load_verification_threshold():
+    with tempfile.TemporaryDirectory() as tmp:
+        config_path = os.path.join(tmp, 'threshold_config.json')
+        assert load_verification_threshold(config_path) == DEFAULT_VERIFICATION_THRESHOLD == 10.9226
+
+        with open(config_path, 'w') as f:
+            f.write('{"threshold": ')
+        assert load_verification_threshold(config_path) == DEFAULT_VERIFICATION_THRESHOLD
+
+        with open(config_path, 'w') as f:
+            json.dump({'far': 0.01}, f)
+        assert load_verification_threshold(config_path) == DEFAULT_VERIFICATION_THRESHOLD
+
+        for bad_threshold in ('NaN', 'Infinity', '-Infinity', '0', '-3.5'):
+            with open(config_path, 'w') as f:
+                f.write(f'{{"threshold": {bad_threshold}}}')
+            assert load_verification_threshold(config_path) == DEFAULT_VERIFICATION_THRESHOLD, bad_threshold
+
+        with open(config_path, 'w') as f:
+            json.dump({'threshold': 9.75, 'far': 0.01}, f)
+        assert load_verification_threshold(config_path) == 9.75
+
+class StubEmbeddingModel:
+    """Stands in for the Keras model: embeds an image as the mean ink of its left and right halves."""
+
+    def predict(self, batch, verbose=0):
+        return np.stack([batch[:, :, :112].mean(axis=(1, 2)), batch[:, :, 112:].mean(axis=(1, 2))], axis=1) * 100
+
+def make_labelled_dataset(root, num_writers=6, genuine_per_writer=4, forged_per_writer=3, seed=4):
+    """Writes <writer>/genuine and <writer>/forged PNGs whose two half-tones place each writer apart."""
+    rng = np.random.default_rng(seed)
+    for writer in range(num_writers):
+        centre = rng.uniform(40, 215, size=2)
+        for subdir, count, spread in (('genuine', genuine_per_writer, 2.0), ('forged', forged_per_writer, 12.0)):
+            os.makedirs(os.path.join(root, f"writer_{writer}", subdir))
+            for i in range(count):
+                left, right = np.clip(centre + rng.normal(scale=spread, size=2), 0, 255).astype(np.uint8)
+                pixels = np.empty((224, 224), dtype=np.uint8)
+                pixels[:, :112], pixels[:, 112:] = left, right
+                Image.fromarray(pixels).save(os.path.join(root, f"writer_{writer}", subdir, f"{i}.png"))
+    # An unreadable image leaves a NaN row that main() must drop.
+    with open(os.path.join(root, "writer_0", "genuine", "broken.png"), 'wb') as f:
+        f.write(b'not an image')
+
+def test_main_writes_summary_and_config():
+    original_loader = signature_model.load_embedding_model
+    signature_model.load_embedding_model = lambda model_path: StubEmbeddingModel()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            dataset, output_dir = os.path.join(tmp, 'dataset'), os.path.join(tmp, 'report')
+            config_path = os.path.join(tmp, 'threshold_config.json')
+            model_path, = make_files(tmp, 'model.h5')
+            make_labelled_dataset(dataset)
+            common = ['--dataset', dataset, '--model', model_path, '--cache-dir', os.path.join(tmp, 'cache'),
+                      '--output-dir', output_dir, '--memory-mb', '1']
+
+            try:
+                evaluate_threshold.main(common + ['--criterion', 'far'])
+            except SystemExit as e:
+                assert e.code == 2
+            else:
+                raise AssertionError("--criterion far was accepted without --target-far")
+
+            for criterion, point, extra in (('youden', 'youden_point', []),
+                                            ('far', 'target_far_point', ['--target-far', '0.05']),
+                                            ('eer', 'eer_point', [])):
+                evaluate_threshold.main(common + ['--criterion', criterion, '--write-config',
+                                                  '--config', config_path] + extra)
+                with open(os.path.join(output_dir, 'summary.json')) as f:
+                    summary = json.load(f)
+                with open(config_path) as f:
+                    config = json.load(f)
+
+                assert summary['criterion'] == criterion and summary['scores'] == 'nearest'
+                assert summary['recommended_threshold'] == summary[point]['threshold']
+                assert summary['recommended_point'] == summary[point]
+                assert summary['num_signatures'] == 6 * (4 + 3)  # broken.png dropped
+                assert summary['genuine_count'] == 6 * 4 and summary['skilled_count'] == 6 * 3
+                assert summary['far_classes'] == ['random', 'skilled']
+                assert config['threshold'] == summary['recommended_threshold']
+                assert config['far'] == summary[point]['far'] and config['frr'] == summary[point]['frr']
+                assert config['far_skilled'] == summary[point]['far_skilled']
+                assert config['far_random'] == summary[point]['far_random']
+                assert config['criterion'] == criterion and config['scores'] == 'nearest'
+                assert load_verification_threshold(config_path) == config['threshold']
+            assert os.path.exists(os.path.join(output_dir, 'curves.csv'))
+    finally:
+        signature_model.load_embedding_model = original_loader
+
+if __name__ == "__main__":
+    test_blocked_histograms_match_brute_force()
+    test_nearest_reference_scores_match_brute_force()
+    test_random_pairs_are_sampled_without_losing_genuine_pairs()
+    test_threshold_separates_genuine_from_forged()
+    test_random_claim_sampling_does_not_move_recommended_threshold()
+    test_histograms_leave_input_untouched_unless_inplace()
+    test_embedding_cache_round_trip_and_resume()
+    test_embedding_cache_skips_truncated_chunk()
+    test_embedding_cache_is_keyed_by_model_and_file_contents()
+    test_parse_vector_reads_pgvector_text()
+    test_load_verification_threshold()
+    test_main_writes_summary_and_config()
+    print("=== All threshold evaluation tests passed ===")